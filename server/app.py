@@ -1,11 +1,21 @@
 import os
 import re
-import json
+import atexit
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from functools import lru_cache
 from typing import Dict, Any, List
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from flask_cors import CORS
+from flask_compress import Compress
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 # Optional: Gemini integration
@@ -14,61 +24,249 @@ try:
 except Exception:
     genai = None
 
+# Optional: shared extraction cache across workers
+try:
+    import redis  # type: ignore
+except Exception:
+    redis = None
+
+# Optional: incremental parsing of large full_studies payloads
+try:
+    import ijson  # type: ignore
+except Exception:
+    ijson = None
+
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Negotiated response compression (library defaults); /api/match bodies are mostly English text
+Compress(app)
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Try configured model first, then fallbacks for compatibility
+GEMINI_CANDIDATE_MODELS = [GEMINI_MODEL,
+                           "gemini-2.5-flash",
+                           "gemini-2.5-flash-latest",
+                           "gemini-1.5-flash-latest",
+                           "gemini-1.5-pro-latest",
+                           "gemini-1.5-flash",
+                           "gemini-1.5-pro"]
+# Use a compact, deterministic prompt and require strict JSON output
+GEMINI_SYSTEM_INSTRUCTION = (
+    "You are extracting structured clinical info from a patient-doctor transcript.\n"
+    "Requirements:\n"
+    "- Output ONLY JSON (no prose).\n"
+    "- Keys: age (number or null), sex ('Male'|'Female'|null), diagnosis (string or null), keywords (string[]), locations (string[]).\n"
+    "- Age must be the patient's current age, not durations (e.g., 'quit 10 years ago' is NOT age).\n"
+    "- Prefer concise, canonical diagnosis terms (e.g., 'Heart failure with reduced ejection fraction (HFrEF)', 'HER2-positive invasive ductal carcinoma').\n"
+    "- Keywords: include staging, biomarkers, therapies (e.g., HER2, HFrEF, NYHA, SGLT2, adjuvant).\n"
+)
 # Use classic endpoints for legacy APIs
 CLINICAL_TRIALS_STUDY_FIELDS = "https://classic.clinicaltrials.gov/api/query/study_fields"
 CLINICAL_TRIALS_FULL_STUDIES = "https://classic.clinicaltrials.gov/api/query/full_studies"
 CLINICAL_TRIALS_V2_STUDIES = "https://clinicaltrials.gov/api/v2/studies"
+# Request pieces that never change, built once
+_STUDY_FIELDS_STR = ",".join([
+    "NCTId","BriefTitle","Condition","OverallStatus","BriefSummary",
+    "LocationCity","LocationState","LocationCountry","Gender",
+    "MinimumAge","MaximumAge","Phase","StudyType","InterventionName",
+    "DetailedDescription","EligibilityCriteria"
+])
+_HEADERS = {"User-Agent": "DeepScribeTrialsDemo/0.1 (+https://example.com)"}
+_BASE_PARAMS_SF = {"fields": _STUDY_FIELDS_STR, "min_rnk": 1, "fmt": "json"}
+_BASE_PARAMS_FULL = {"min_rnk": 1, "fmt": "json"}
+REDIS_URL = os.getenv("REDIS_URL", "")
+EXTRACT_CACHE_SIZE = 512
+EXTRACT_CACHE_TTL = 3600  # seconds, Redis layer only
+TRIALS_CACHE_SIZE = 1024
+TRIALS_CACHE_TTL = 900  # seconds
+UPSTREAM_TIMEOUT = 25  # seconds a request waits on each upstream stage, queueing included
+GEMINI_TIMEOUT = 20  # seconds across all Gemini model attempts for one extraction
+TRIALS_DEADLINE = 20  # seconds for the whole endpoint race, losers included
+IO_WORKERS = 32
+
+# Patterns compiled once at import; several run per request or per study
+# Age forms in one alternation: 'yo' / 'aged' are specific, 'gen' is generic
+_AGE_ALL_RE = re.compile(
+    r"\b(?:(?P<yo>\d{1,3})\s*[- ]?(?:year|yr)s?[- ]?old\b"
+    r"|aged\s*(?P<aged>\d{1,3})\b"
+    r"|(?P<gen>\d{1,3})\s*(?:years?|yo|y/o)\b)"
+)
+# Keywords harvested by the regex fallback, in output order
+_HARVEST_KEYWORDS = [
+    "stage ii", "stage iii", "metastatic", "recurrent", "adjuvant",
+    "neoadjuvant", "immunotherapy", "chemo", "radiation", "biomarker",
+    "egfr", "alk", "brca", "pd-l1", "her2",
+    # Cardiology
+    "heart failure", "hfrEF", "reduced ejection fraction", "nyha", "sglt2"
+]
+_SEX_RE = re.compile(r"\b(male|female|man|woman)\b")
+_DX_RE = re.compile(r"diagnos(?:is|ed)\s*(?:with)?\s*([\w\s\-]+?)(?:\.|,|;|$)")
+_HFREF_RE = re.compile(r"\bhfref\b")
+_LOCATION_RE = re.compile(r"\b(?:in|at)\s+([A-Z][a-zA-Z]+(?:\s[A-Z][a-zA-Z]+)*)\b")
+_FIRST_INT_RE = re.compile(r"\b(\d{1,3})\b")
+
+# One pooled client for all ClinicalTrials.gov calls so TLS sessions and
+# HTTP/2 connections are reused across requests (httpx.Client is thread-safe).
+_HTTPX = httpx.Client(
+    timeout=20,
+    headers=_HEADERS,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=3 * IO_WORKERS),
+)
+atexit.register(_HTTPX.close)
+# Worker threads for racing the ClinicalTrials.gov endpoints: one per endpoint for
+# every query_trials that _IO can run at once, so abandoned losers (bounded by
+# TRIALS_DEADLINE) never queue ahead of a new request's fetches.
+_FETCH_POOL = ThreadPoolExecutor(max_workers=3 * IO_WORKERS, thread_name_prefix="trials")
+# Bounded pool for the blocking Gemini / ClinicalTrials.gov stages of each request.
+# Kept separate from _FETCH_POOL so query_trials never waits on its own pool.
+_IO = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="upstream")
+
+if GOOGLE_API_KEY and genai is not None:
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+# First candidate that answered after every model ahead of it was not found (404);
+# skips re-probing ids that do not exist. Transient errors never move it.
+_resolved_model: str | None = None
+# GenerativeModel instances by id, each built once with the system instruction
+_gemini_models: Dict[str, Any] = {}
+
+
+def _is_model_not_found(exc: Exception) -> bool:
+    """True for google.api_core NotFound (HTTP 404), i.e. the model id does not exist."""
+    return type(exc).__name__ == "NotFound" or getattr(exc, "code", None) == 404
+
+
+def _gemini_model(mid: str) -> Any:
+    model = _gemini_models.get(mid)
+    if model is None:
+        model = genai.GenerativeModel(mid, system_instruction=GEMINI_SYSTEM_INSTRUCTION)
+        _gemini_models[mid] = model
+    return model
+
+# ---------- Extraction cache ----------
+
+_extract_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_extract_cache_lock = threading.Lock()
+# Redis entries are shared across workers and deploys, so the key carries a hash of the
+# configured model and prompt; changing either starts from an empty cache.
+_REDIS_KEY_PREFIX = "extract:" + hashlib.blake2b(
+    f"{GEMINI_MODEL}\0{GEMINI_SYSTEM_INSTRUCTION}".encode(), digest_size=6
+).hexdigest() + ":"
+# Short socket timeouts: redis-py blocks forever by default, which would pin _IO threads
+# when Redis is unreachable instead of letting the lookup fail as a cache miss.
+_redis = (
+    redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    if (redis is not None and REDIS_URL) else None
+)
+
+
+def _transcript_key(transcript: str) -> str:
+    """Content hash used as cache key, so full transcripts are not retained as keys."""
+    return hashlib.blake2b(transcript.encode(), digest_size=16).hexdigest()
+
+
+def _extract_cache_get(key: str) -> Dict[str, Any] | None:
+    with _extract_cache_lock:
+        hit = _extract_cache.get(key)
+        if hit is not None:
+            _extract_cache.move_to_end(key)
+            return copy.deepcopy(hit)
+    if _redis is None:
+        return None
+    try:
+        raw = _redis.get(_REDIS_KEY_PREFIX + key)
+    except Exception:
+        return None
+    if raw is None:
+        return None
+    try:
+        result = orjson.loads(raw)
+    except Exception:
+        # Corrupt or incompatible entry: treat as a miss
+        return None
+    if not isinstance(result, dict):
+        return None
+    with _extract_cache_lock:
+        _extract_cache[key] = copy.deepcopy(result)
+        if len(_extract_cache) > EXTRACT_CACHE_SIZE:
+            _extract_cache.popitem(last=False)
+    return result
+
+
+def _extract_cache_put(key: str, result: Dict[str, Any]) -> None:
+    with _extract_cache_lock:
+        _extract_cache[key] = copy.deepcopy(result)
+        _extract_cache.move_to_end(key)
+        if len(_extract_cache) > EXTRACT_CACHE_SIZE:
+            _extract_cache.popitem(last=False)
+    if _redis is not None:
+        try:
+            _redis.setex(_REDIS_KEY_PREFIX + key, EXTRACT_CACHE_TTL, orjson.dumps(result))
+        except Exception:
+            pass
+
+# ---------- Trials cache ----------
+
+# (expires_at, result) keyed by (expr, max_rows, age, sex); age/sex are part of the
+# key because the cached result has already been filtered locally.
+_trials_cache: "OrderedDict[tuple, tuple[float, Dict[str, Any]]]" = OrderedDict()
+_trials_cache_lock = threading.Lock()
+
+
+def _trials_cache_get(key: tuple) -> Dict[str, Any] | None:
+    with _trials_cache_lock:
+        hit = _trials_cache.get(key)
+        if hit is None:
+            return None
+        expires_at, result = hit
+        if expires_at < time.monotonic():
+            del _trials_cache[key]
+            return None
+        _trials_cache.move_to_end(key)
+        return copy.deepcopy(result)
+
+
+def _trials_cache_put(key: tuple, result: Dict[str, Any]) -> None:
+    with _trials_cache_lock:
+        _trials_cache[key] = (time.monotonic() + TRIALS_CACHE_TTL, copy.deepcopy(result))
+        _trials_cache.move_to_end(key)
+        if len(_trials_cache) > TRIALS_CACHE_SIZE:
+            _trials_cache.popitem(last=False)
 
 # ---------- Utilities ----------
 
-def _extract_age_from_text(text: str) -> tuple[int | None, bool]:
+def _extract_age_from_text(text: str, lower: str | None = None) -> tuple[int | None, bool]:
     """Find age using multiple patterns; return (age, specific_found).
     specific_found is True when pattern is 'X-year-old' or 'aged X', which is more reliable
     than generic 'X years' that can refer to durations.
+    Pass `lower` when the caller already has text.lower() to avoid another copy.
     """
-    lower = text.lower()
-    matches: list[tuple[int, int, bool]] = []  # (start_index, age, is_specific)
-    # Specific forms first: '68-year-old', 'aged 68'
-    for m in re.finditer(r"\b(\d{1,3})\s*[- ]?(?:year|yr)s?[- ]?old\b", lower):
-        try:
-            matches.append((m.start(), int(m.group(1)), True))
-        except Exception:
-            pass
-    for m in re.finditer(r"\baged\s*(\d{1,3})\b", lower):
-        try:
-            matches.append((m.start(), int(m.group(1)), True))
-        except Exception:
-            pass
-    # Generic forms: '58 years', '58 yo', '58 y/o'
-    for m in re.finditer(r"\b(\d{1,3})\s*(?:years?|yo|y/o)\b", lower):
-        try:
-            matches.append((m.start(), int(m.group(1)), False))
-        except Exception:
-            pass
-    if not matches:
+    if lower is None:
+        lower = text.lower()
+    # A single left-to-right scan: the first match is the earliest occurrence, and at
+    # equal positions the specific alternatives are tried before the generic one.
+    m = _AGE_ALL_RE.search(lower)
+    if not m:
         return (None, False)
-    # Choose earliest occurrence; if tie, prefer specific=True
-    matches.sort(key=lambda t: (t[0], 0 if t[2] else 1))
-    _, age, is_specific = matches[0]
+    is_specific = m.group("gen") is None
+    age = int(m.group("yo") or m.group("aged") or m.group("gen"))
     if age < 0 or age > 120:
         return (None, is_specific)
     return (age, is_specific)
 
 
-def _regex_extract(text: str) -> Dict[str, Any]:
+def _regex_extract(text: str, lower: str | None = None) -> Dict[str, Any]:
     """Very simple heuristic extractor as a safe fallback when no LLM key is set."""
-    lower = text.lower()
+    if lower is None:
+        lower = text.lower()
     # Find age robustly
-    age_val, _ = _extract_age_from_text(text)
-    sex_match = re.search(r"\b(male|female|man|woman)\b", lower)
-    dx_match = re.search(r"diagnos(?:is|ed)\s*(?:with)?\s*([\w\s\-]+?)(?:\.|,|;|$)", lower)
+    age_val, _ = _extract_age_from_text(text, lower)
+    sex_match = _SEX_RE.search(lower)
+    dx_match = _DX_RE.search(lower)
 
     def norm_sex(s: str | None) -> str | None:
         if not s:
@@ -85,90 +283,111 @@ def _regex_extract(text: str) -> Dict[str, Any]:
     if not diagnosis:
         # Cardiology patterns
         if "heart failure" in lower:
-            if "reduced ejection fraction" in lower or re.search(r"\bhfref\b", lower):
+            if "reduced ejection fraction" in lower or _HFREF_RE.search(lower):
                 diagnosis = "Heart failure with reduced ejection fraction (HFrEF)"
             else:
                 diagnosis = "Heart failure"
 
     # simple keyword harvesting
-    keywords = []
-    for kw in [
-        "stage ii", "stage iii", "metastatic", "recurrent", "adjuvant",
-        "neoadjuvant", "immunotherapy", "chemo", "radiation", "biomarker",
-        "egfr", "alk", "brca", "pd-l1", "her2",
-        # Cardiology
-        "heart failure", "hfrEF", "reduced ejection fraction", "nyha", "sglt2"
-    ]:
-        if kw in lower:
-            keywords.append(kw)
-
-    locations = []
-    for m in re.finditer(r"\b(in|at)\s+([A-Z][a-zA-Z]+(?:\s[A-Z][a-zA-Z]+)*)\b", text):
-        loc = m.group(2)
-        if loc not in locations and len(loc) > 2:
-            locations.append(loc)
+    # `in` is a C-level substring scan; a Python regex alternation over the
+    # whole list is several times slower than these 20 checks.
+    keywords = [kw for kw in _HARVEST_KEYWORDS if kw in lower]
+
+    locations: Dict[str, None] = {}
+    for m in _LOCATION_RE.finditer(text):
+        loc = m.group(1)
+        if len(loc) > 2:
+            locations.setdefault(loc, None)
 
     return {
         "age": age,
         "sex": sex,
         "diagnosis": diagnosis,
         "keywords": keywords,
-        "locations": locations[:3],
+        "locations": list(locations)[:3],
     }
 
+def _first_json_object(text: str) -> str | None:
+    """Return the first balanced {...} block in text, ignoring braces inside JSON strings."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_str = escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
 def _gemini_extract(transcript: str) -> Dict[str, Any]:
+    global _resolved_model
     if not GOOGLE_API_KEY or genai is None:
         
         return _regex_extract(transcript)
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # Use a compact, deterministic prompt and require strict JSON output
-    prompt = (
-        "You are extracting structured clinical info from a patient-doctor transcript.\n"
-        "Requirements:\n"
-        "- Output ONLY JSON (no prose).\n"
-        "- Keys: age (number or null), sex ('Male'|'Female'|null), diagnosis (string or null), keywords (string[]), locations (string[]).\n"
-        "- Age must be the patient's current age, not durations (e.g., 'quit 10 years ago' is NOT age).\n"
-        "- Prefer concise, canonical diagnosis terms (e.g., 'Heart failure with reduced ejection fraction (HFrEF)', 'HER2-positive invasive ductal carcinoma').\n"
-        "- Keywords: include staging, biomarkers, therapies (e.g., HER2, HFrEF, NYHA, SGLT2, adjuvant).\n"
-        "Transcript:\n\n" + transcript
-    )
+    # Only successful Gemini results are cached; regex fallbacks are cheap to recompute
+    cache_key = _transcript_key(transcript)
+    cached = _extract_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    # Lowercased once, shared by the textual age check and the regex fallback
+    lower = transcript.lower()
+    # Instructions travel as the model's system instruction; only the transcript is sent per call
+    prompt = "Transcript:\n\n" + transcript
     try:
-        # Try configured model first, then fallbacks for compatibility
-        candidate_models = [GEMINI_MODEL,
-                            "gemini-2.5-flash",
-                            "gemini-2.5-flash-latest",
-                            "gemini-1.5-flash-latest",
-                            "gemini-1.5-pro-latest",
-                            "gemini-1.5-flash",
-                            "gemini-1.5-pro"]
+        # Models that do not exist are skipped once resolved; otherwise GEMINI_MODEL goes first
+        candidate_models = list(dict.fromkeys(
+            ([_resolved_model] if _resolved_model else []) + GEMINI_CANDIDATE_MODELS
+        ))
         last_exc = None
+        only_not_found = True
+        # One budget for all attempts so a stuck call cannot hold an _IO thread indefinitely
+        deadline = time.monotonic() + GEMINI_TIMEOUT
         for mid in candidate_models:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise last_exc or TimeoutError("Gemini extraction timed out")
             try:
-                model = genai.GenerativeModel(mid)
+                model = _gemini_model(mid)
                 resp = model.generate_content(prompt, generation_config={
                     "temperature": 0.2,
                     "top_p": 0.9,
-                })
+                }, request_options={"timeout": remaining})
+                if only_not_found:
+                    _resolved_model = mid
                 break
             except Exception as e_model:
                 last_exc = e_model
+                if not _is_model_not_found(e_model):
+                    only_not_found = False
                 continue
         else:
             raise last_exc or RuntimeError("No Gemini model succeeded")
         text = resp.text.strip()
         # Try to locate JSON in response
-        json_str = text
-        m = re.search(r"\{[\s\S]*\}", text)
-        if m:
-            json_str = m.group(0)
-        data = json.loads(json_str)
+        json_str = _first_json_object(text) or text
+        data = orjson.loads(json_str)
         # basic normalization
         if isinstance(data.get("sex"), str):
             s = data["sex"].lower()
             data["sex"] = "Male" if "male" in s else ("Female" if "female" in s else None)
         # normalize age if string like '58-year-old'
         if isinstance(data.get("age"), str):
-            m_age = re.search(r"\b(\d{1,3})\b", data["age"])  # extract first integer
+            m_age = _FIRST_INT_RE.search(data["age"])  # extract first integer
             if m_age:
                 try:
                     data["age"] = int(m_age.group(1))
@@ -178,30 +397,42 @@ def _gemini_extract(transcript: str) -> Dict[str, Any]:
         if isinstance(data.get("age"), int) and (data["age"] < 0 or data["age"] > 120):
             data["age"] = None
         # If LLM age is missing, fall back to textual age
-        txt_age, _ = _extract_age_from_text(transcript)
+        txt_age, _ = _extract_age_from_text(transcript, lower)
         if txt_age is not None and data.get("age") is None:
             data["age"] = txt_age
             
-        return {
+        result = {
             "age": data.get("age"),
             "sex": data.get("sex"),
             "diagnosis": data.get("diagnosis"),
             "keywords": data.get("keywords", [])[:10],
             "locations": data.get("locations", [])[:5],
         }
+        _extract_cache_put(cache_key, result)
+        return result
     except Exception as e:
         
-        return _regex_extract(transcript)
+        return _regex_extract(transcript, lower)
 
 
 def build_expr(extracted: Dict[str, Any]) -> str:
-    parts: List[str] = []
-    dx = (extracted.get("diagnosis") or "").lower()
-    kws = [k.lower() for k in (extracted.get("keywords") or [])]
+    # Pure over diagnosis + keywords, so memoize on that fingerprint
+    return _build_expr_cached(
+        extracted.get("diagnosis") or "",
+        tuple(extracted.get("keywords") or []),
+    )
+
+
+@lru_cache(maxsize=2048)
+def _build_expr_cached(diagnosis: str, keywords: tuple[str, ...]) -> str:
+    # Insertion-ordered dicts double as ordered sets: O(1) dedupe, stable output order
+    parts: Dict[str, None] = {}
+    dx = diagnosis.lower()
+    kws = [k.lower() for k in keywords]
 
     def add(term: str):
-        if term and term not in parts:
-            parts.append(term)
+        if term:
+            parts.setdefault(term, None)
 
     # Expand diagnosis for common synonyms
     if "breast" in dx or "ductal" in dx:
@@ -224,46 +455,49 @@ def build_expr(extracted: Dict[str, Any]) -> str:
             add(dx)
 
     # Add a few keywords (quoted if multi-word), prefer therapeutic intents
-    priors = []
+    priors: Dict[str, None] = {}
     for kw in kws:
         if kw in priors:
             continue
-        priors.append(kw)
+        priors[kw] = None
         if len(priors) > 5:
             break
         add(f'"{kw}"' if ' ' in kw else kw)
 
     # Fallback generic anchors
     if not parts:
-        parts = ['"breast cancer"', 'HER2']
+        parts = dict.fromkeys(['"breast cancer"', 'HER2'])
 
     # Compose with OR to avoid overly restrictive AND
     return " OR ".join(parts)
 
 
+@lru_cache(maxsize=256)
+def _age_to_years(s: str | None) -> int | None:
+    """Parse a ClinicalTrials.gov age bound like '18 Years'; memoized as the values repeat heavily."""
+    if not s:
+        return None
+    # Leading integer followed by an optional unit; no regex needed for inputs this small.
+    # Non-numeric values such as 'N/A' or 'None' fall out at the digit scan.
+    i = 0
+    while i < len(s) and "0" <= s[i] <= "9":
+        i += 1
+    if not i:
+        return None
+    val = int(s[:i])
+    unit = s[i:].lstrip().lower()
+    if unit.startswith("month"):
+        return val // 12
+    if unit.startswith("day"):
+        return val // 365
+    return val
+
+
 def age_in_range(age: int | None, min_age: str | None, max_age: str | None) -> bool:
     if age is None:
         return True
-    def to_years(s: str | None) -> int | None:
-        if not s:
-            return None
-        s = s.lower()
-        if s in ("n/a", "none", ""):
-            return None
-        m = re.match(r"(\d+)\s*(year|years|month|months|day|days)?", s)
-        if not m:
-            return None
-        val = int(m.group(1))
-        unit = m.group(2) or "years"
-        if unit.startswith("year"):
-            return val
-        if unit.startswith("month"):
-            return max(0, val // 12)
-        if unit.startswith("day"):
-            return max(0, val // 365)
-        return val
-    miny = to_years(min_age)
-    maxy = to_years(max_age)
+    miny = _age_to_years(min_age)
+    maxy = _age_to_years(max_age)
     if miny is not None and age < miny:
         return False
     if maxy is not None and age > maxy:
@@ -284,227 +518,51 @@ def sex_matches(sex: str | None, trial_gender: str | None) -> bool:
     return False
 
 
-def query_trials(extracted: Dict[str, Any], max_rows: int = 30) -> Dict[str, Any]:
-    expr = build_expr(extracted)
-    fields = [
-        "NCTId","BriefTitle","Condition","OverallStatus","BriefSummary",
-        "LocationCity","LocationState","LocationCountry","Gender",
-        "MinimumAge","MaximumAge","Phase","StudyType","InterventionName",
-        "DetailedDescription","EligibilityCriteria"
-    ]
-    params = {
-        "expr": expr,
-        "fields": ",".join(fields),
-        "min_rnk": 1,
-        "max_rnk": max_rows,
-        "fmt": "json",
-    }
-    headers = {"User-Agent": "DeepScribeTrialsDemo/0.1 (+https://example.com)"}
-    try:
-        with httpx.Client(timeout=20, headers=headers) as client:
-            r = client.get(CLINICAL_TRIALS_STUDY_FIELDS, params=params)
-            r.raise_for_status()
-            data = r.json()
-    except httpx.HTTPError as e:
-        # Fallback: try full_studies and map a subset of fields
-        try:
-            with httpx.Client(timeout=20, headers=headers) as client:
-                r2 = client.get(CLINICAL_TRIALS_FULL_STUDIES, params={
-                    "expr": expr,
-                    "min_rnk": 1,
-                    "max_rnk": max_rows,
-                    "fmt": "json",
-                })
-                r2.raise_for_status()
-                data2 = r2.json()
-            studies = data2.get("FullStudiesResponse", {}).get("FullStudies", [])
-            mapped = []
-            for item in studies:
-                study = (item or {}).get("Study", {})
-                proto = study.get("ProtocolSection", {})
-                id_module = proto.get("IdentificationModule", {})
-                desc_module = proto.get("DescriptionModule", {})
-                status_module = proto.get("StatusModule", {})
-                design_module = proto.get("DesignModule", {})
-                eligibility = proto.get("EligibilityModule", {})
-                contacts = proto.get("ContactsLocationsModule", {})
-                interventions = proto.get("ArmsInterventionsModule", {}) or proto.get("InterventionsModule", {})
-
-                nct_id = id_module.get("NCTId")
-                title = id_module.get("BriefTitle") or study.get("ProtocolSection", {}).get("IdentificationModule", {}).get("OfficialTitle")
-                conditions = proto.get("ConditionsModule", {}).get("ConditionList", {}).get("Condition", [])
-                overall_status = status_module.get("OverallStatus")
-                brief_summary = desc_module.get("BriefSummary") or ""
-                phase_val = design_module.get("PhaseList", {}).get("Phase")
-                if isinstance(phase_val, list):
-                    phase_list = phase_val
-                elif phase_val:
-                    phase_list = [phase_val]
-                else:
-                    phase_list = []
-                study_type = design_module.get("StudyType")
-                gender = (eligibility.get("Gender") or "All")
-                min_age = eligibility.get("MinimumAge") or "N/A"
-                max_age = eligibility.get("MaximumAge") or "N/A"
-
-                # locations
-                locs = (contacts.get("LocationList", {}) or {}).get("Location", [])
-                loc_city, loc_state, loc_country = [], [], []
-                for loc in locs:
-                    fac = (loc or {}).get("Facility", {})
-                    l = fac.get("Location", {})
-                    if l.get("City"): loc_city.append(l.get("City"))
-                    if l.get("State"): loc_state.append(l.get("State"))
-                    if l.get("Country"): loc_country.append(l.get("Country"))
-
-                # interventions
-                names = []
-                if interventions:
-                    # try InterventionsModule.InterventionList.Intervention[].InterventionName
-                    im = proto.get("InterventionsModule", {})
-                    ilist = (im.get("InterventionList", {}) or {}).get("Intervention", [])
-                    for iv in ilist:
-                        nm = iv.get("InterventionName")
-                        if nm: names.append(nm)
-                mapped.append({
-                    "NCTId": [nct_id] if nct_id else [],
-                    "BriefTitle": [title] if title else [],
-                    "Condition": conditions or [],
-                    "OverallStatus": [overall_status] if overall_status else [],
-                    "BriefSummary": [brief_summary],
-                    "LocationCity": loc_city,
-                    "LocationState": loc_state,
-                    "LocationCountry": loc_country,
-                    "Gender": [gender] if gender else [],
-                    "MinimumAge": [min_age] if min_age else [],
-                    "MaximumAge": [max_age] if max_age else [],
-                    "Phase": phase_list,
-                    "StudyType": [study_type] if study_type else [],
-                    "InterventionName": names,
-                    "DetailedDescription": [],
-                    "EligibilityCriteria": [],
-                })
-            # Apply same local filters
-            age = extracted.get("age")
-            sex = extracted.get("sex")
-            filtered = []
-            for s in mapped:
-                gender = (s.get("Gender") or [None])[0]
-                min_age = (s.get("MinimumAge") or [None])[0]
-                max_age = (s.get("MaximumAge") or [None])[0]
-                if not age_in_range(age, min_age, max_age):
-                    continue
-                if not sex_matches(sex, gender):
-                    continue
-                filtered.append(s)
-            return {"expr": expr, "count": len(filtered), "studies": filtered[:15], "endpoint": CLINICAL_TRIALS_FULL_STUDIES}
-        except httpx.HTTPError as e2:
-            # Second fallback: v2 API
-            try:
-                with httpx.Client(timeout=20, headers=headers) as client:
-                    r3 = client.get(CLINICAL_TRIALS_V2_STUDIES, params={
-                        "query.term": expr,
-                        "pageSize": max_rows,
-                    })
-                    r3.raise_for_status()
-                    data3 = r3.json()
-                studies_v2 = data3.get("studies", [])
-                mapped_v2 = []
-                for s in studies_v2:
-                    proto = (s or {}).get("protocolSection", {})
-                    idm = proto.get("identificationModule", {})
-                    desc = proto.get("descriptionModule", {})
-                    status = proto.get("statusModule", {})
-                    design = proto.get("designModule", {})
-                    elig = proto.get("eligibilityModule", {})
-                    contacts = proto.get("contactsLocationsModule", {})
-                    imods = proto.get("interventionsModule", {})
-
-                    nct_id = idm.get("nctId")
-                    title = idm.get("briefTitle") or idm.get("officialTitle")
-                    conditions = (proto.get("conditionsModule", {}) or {}).get("conditions", [])
-                    overall_status = status.get("overallStatus")
-                    brief_summary = desc.get("briefSummary") or ""
-                    phase_list = design.get("phases") or []
-                    study_type = design.get("studyType")
-                    gender = elig.get("sex") or "All"
-                    min_age = elig.get("minimumAge") or "N/A"
-                    max_age = elig.get("maximumAge") or "N/A"
-
-                    # locations
-                    locs = (contacts.get("locations") or [])
-                    loc_city, loc_state, loc_country = [], [], []
-                    for loc in locs:
-                        l = loc.get("location") or {}
-                        if l.get("city"): loc_city.append(l.get("city"))
-                        if l.get("state"): loc_state.append(l.get("state"))
-                        if l.get("country"): loc_country.append(l.get("country"))
-
-                    # interventions
-                    names = []
-                    ivs = (imods.get("interventions") or [])
-                    for iv in ivs:
-                        nm = iv.get("name")
-                        if nm: names.append(nm)
-
-                    mapped_v2.append({
-                        "NCTId": [nct_id] if nct_id else [],
-                        "BriefTitle": [title] if title else [],
-                        "Condition": conditions or [],
-                        "OverallStatus": [overall_status] if overall_status else [],
-                        "BriefSummary": [brief_summary],
-                        "LocationCity": loc_city,
-                        "LocationState": loc_state,
-                        "LocationCountry": loc_country,
-                        "Gender": [gender] if gender else [],
-                        "MinimumAge": [min_age] if min_age else [],
-                        "MaximumAge": [max_age] if max_age else [],
-                        "Phase": phase_list,
-                        "StudyType": [study_type] if study_type else [],
-                        "InterventionName": names,
-                        "DetailedDescription": [],
-                        "EligibilityCriteria": [],
-                    })
-
-                # Apply same filters
-                age = extracted.get("age")
-                sex = extracted.get("sex")
-                filtered = []
-                for s in mapped_v2:
-                    gender = (s.get("Gender") or [None])[0]
-                    min_age = (s.get("MinimumAge") or [None])[0]
-                    max_age = (s.get("MaximumAge") or [None])[0]
-                    if not age_in_range(age, min_age, max_age):
-                        continue
-                    if not sex_matches(sex, gender):
-                        continue
-                    filtered.append(s)
-
-                return {"expr": expr, "count": len(filtered), "studies": filtered[:15], "endpoint": CLINICAL_TRIALS_V2_STUDIES}
-            except httpx.HTTPError as e3:
-                return {
-                    "expr": expr,
-                    "count": 0,
-                    "studies": [],
-                    "error": f"study_fields error: {str(e)}; full_studies error: {str(e2)}; v2 error: {str(e3)}",
-                    "endpoint": CLINICAL_TRIALS_V2_STUDIES,
-                }
-    studies = data.get("StudyFieldsResponse", {}).get("StudyFields", [])
-
-    # local filtering based on age and sex
+def _filter_studies(studies: List[Dict[str, Any]], extracted: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Local age/sex filtering over study_fields-shaped rows (each field is a list)."""
     age = extracted.get("age")
     sex = extracted.get("sex")
+    if age is None and sex is None:
+        return list(studies)
     filtered = []
     for s in studies:
-        # each field returns list values from API
-        gender = (s.get("Gender") or [None])[0]
-        min_age = (s.get("MinimumAge") or [None])[0]
-        max_age = (s.get("MaximumAge") or [None])[0]
-        if not age_in_range(age, min_age, max_age):
+        if not age_in_range(age, (s.get("MinimumAge") or [None])[0], (s.get("MaximumAge") or [None])[0]):
             continue
-        if not sex_matches(sex, gender):
+        if not sex_matches(sex, (s.get("Gender") or [None])[0]):
             continue
         filtered.append(s)
+    return filtered
+
+
+def query_trials(extracted: Dict[str, Any], max_rows: int = 30) -> Dict[str, Any]:
+    expr = build_expr(extracted)
+    cache_key = (expr, max_rows, extracted.get("age"), extracted.get("sex"))
+    cached = _trials_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    results = _query_trials_uncached(extracted, expr, max_rows)
+    # Only results with studies are cached; errors and empty answers (possibly from
+    # a degraded endpoint while the others failed) are retried on the next request
+    if not results.get("error") and results.get("studies"):
+        _trials_cache_put(cache_key, results)
+    return results
+
+
+def _remaining(deadline: float) -> float:
+    """Seconds left before `deadline`, used as the httpx timeout so no single
+    connect/read can outlive the race."""
+    return max(0.1, deadline - time.monotonic())
+
+
+def _query_study_fields(extracted: Dict[str, Any], expr: str, max_rows: int, deadline: float) -> Dict[str, Any]:
+    params = {**_BASE_PARAMS_SF, "expr": expr, "max_rnk": max_rows}
+    r = _HTTPX.get(CLINICAL_TRIALS_STUDY_FIELDS, params=params, timeout=_remaining(deadline))
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    studies = data.get("StudyFieldsResponse", {}).get("StudyFields", [])
+
+    # local filtering based on age and sex
+    filtered = _filter_studies(studies, extracted)
 
     # If no filtered results but there were raw studies, return top unfiltered to avoid empty UI
     if not filtered and studies:
@@ -521,11 +579,225 @@ def query_trials(extracted: Dict[str, Any], max_rows: int = 30) -> Dict[str, Any
         "studies": filtered[:15],
     }
 
+
+def _stream_json_items(response: httpx.Response, prefix: str, limit: int, deadline: float) -> List[Any]:
+    """Parse items under `prefix` as the body streams in, stopping after `limit` items
+    so the rest of the payload is neither buffered nor downloaded."""
+    items: List[Any] = []
+    events = ijson.sendable_list()
+    coro = ijson.items_coro(events, prefix, use_float=True)
+    for chunk in response.iter_bytes():
+        if time.monotonic() > deadline:
+            raise httpx.ReadTimeout("full_studies deadline exceeded")
+        coro.send(chunk)
+        items.extend(events)
+        del events[:]
+        if len(items) >= limit:
+            return items[:limit]
+    coro.close()
+    items.extend(events)
+    return items[:limit]
+
+
+# Field tables mapping full_studies / v2 records onto the study_fields shape (every
+# field a list). Paths are dotted and relative to the record's protocol section; a
+# segment ending in "[]" fans out over a list. Alternatives are tried in order and
+# the default fills fields that are empty on every path.
+_FULL_STUDIES_MAPPING = {
+    "NCTId": (["IdentificationModule.NCTId"], None),
+    "BriefTitle": (["IdentificationModule.BriefTitle", "IdentificationModule.OfficialTitle"], None),
+    "Condition": (["ConditionsModule.ConditionList.Condition"], None),
+    "OverallStatus": (["StatusModule.OverallStatus"], None),
+    "BriefSummary": (["DescriptionModule.BriefSummary"], ""),
+    "LocationCity": (["ContactsLocationsModule.LocationList.Location[].Facility.Location.City"], None),
+    "LocationState": (["ContactsLocationsModule.LocationList.Location[].Facility.Location.State"], None),
+    "LocationCountry": (["ContactsLocationsModule.LocationList.Location[].Facility.Location.Country"], None),
+    "Gender": (["EligibilityModule.Gender"], "All"),
+    "MinimumAge": (["EligibilityModule.MinimumAge"], "N/A"),
+    "MaximumAge": (["EligibilityModule.MaximumAge"], "N/A"),
+    "Phase": (["DesignModule.PhaseList.Phase"], None),
+    "StudyType": (["DesignModule.StudyType"], None),
+    "InterventionName": (["InterventionsModule.InterventionList.Intervention[].InterventionName"], None),
+    "DetailedDescription": ([], None),
+    "EligibilityCriteria": ([], None),
+}
+_V2_MAPPING = {
+    "NCTId": (["identificationModule.nctId"], None),
+    "BriefTitle": (["identificationModule.briefTitle", "identificationModule.officialTitle"], None),
+    "Condition": (["conditionsModule.conditions"], None),
+    "OverallStatus": (["statusModule.overallStatus"], None),
+    "BriefSummary": (["descriptionModule.briefSummary"], ""),
+    "LocationCity": (["contactsLocationsModule.locations[].location.city"], None),
+    "LocationState": (["contactsLocationsModule.locations[].location.state"], None),
+    "LocationCountry": (["contactsLocationsModule.locations[].location.country"], None),
+    "Gender": (["eligibilityModule.sex"], "All"),
+    "MinimumAge": (["eligibilityModule.minimumAge"], "N/A"),
+    "MaximumAge": (["eligibilityModule.maximumAge"], "N/A"),
+    "Phase": (["designModule.phases"], None),
+    "StudyType": (["designModule.studyType"], None),
+    "InterventionName": (["interventionsModule.interventions[].name"], None),
+    "DetailedDescription": ([], None),
+    "EligibilityCriteria": ([], None),
+}
+
+
+def _compile_mapping(mapping: Dict[str, tuple]) -> List[tuple]:
+    """Pre-split paths into (key, fan_out) steps once at import."""
+    return [
+        (field, [[(seg.removesuffix("[]"), seg.endswith("[]")) for seg in path.split(".")] for path in paths], default)
+        for field, (paths, default) in mapping.items()
+    ]
+
+
+_FULL_STUDIES_FIELDS = _compile_mapping(_FULL_STUDIES_MAPPING)
+_V2_FIELDS = _compile_mapping(_V2_MAPPING)
+
+
+def _walk(node: Any, steps: List[tuple]) -> List[Any]:
+    """Non-empty values at a compiled path; leaf lists are flattened one level."""
+    nodes = [node]
+    for key, fan_out in steps:
+        nxt = []
+        for n in nodes:
+            val = n.get(key) if isinstance(n, dict) else None
+            if val is None:
+                continue
+            if fan_out and isinstance(val, list):
+                nxt.extend(val)
+            else:
+                nxt.append(val)
+        nodes = nxt
+    values = []
+    for v in nodes:
+        if isinstance(v, list):
+            values.extend(x for x in v if x)
+        elif v:
+            values.append(v)
+    return values
+
+
+def _apply_mapping(proto: Dict[str, Any], fields: List[tuple]) -> Dict[str, Any]:
+    row = {}
+    for field, paths, default in fields:
+        values = []
+        for steps in paths:
+            values = _walk(proto, steps)
+            if values:
+                break
+        if not values and default is not None:
+            values = [default]
+        row[field] = values
+    return row
+
+
+def _query_full_studies(extracted: Dict[str, Any], expr: str, max_rows: int, deadline: float) -> Dict[str, Any]:
+    # Fallback: full_studies, mapped to a subset of the study_fields shape
+    params = {**_BASE_PARAMS_FULL, "expr": expr, "max_rnk": max_rows}
+    with _HTTPX.stream("GET", CLINICAL_TRIALS_FULL_STUDIES, params=params, timeout=_remaining(deadline)) as r:
+        r.raise_for_status()
+        if ijson is not None:
+            studies = _stream_json_items(r, "FullStudiesResponse.FullStudies.item", max_rows, deadline)
+        else:
+            r.read()
+            data = orjson.loads(r.content)
+            studies = data.get("FullStudiesResponse", {}).get("FullStudies", [])
+    mapped = [
+        _apply_mapping(((item or {}).get("Study") or {}).get("ProtocolSection") or {}, _FULL_STUDIES_FIELDS)
+        for item in studies
+    ]
+    # Apply same local filters
+    filtered = _filter_studies(mapped, extracted)
+    return {"expr": expr, "count": len(filtered), "studies": filtered[:15], "endpoint": CLINICAL_TRIALS_FULL_STUDIES}
+
+
+def _query_v2(extracted: Dict[str, Any], expr: str, max_rows: int, deadline: float) -> Dict[str, Any]:
+    # Fallback: v2 API, mapped to the study_fields shape
+    r = _HTTPX.get(CLINICAL_TRIALS_V2_STUDIES, params={
+        "query.term": expr,
+        "pageSize": max_rows,
+    }, timeout=_remaining(deadline))
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    mapped = [
+        _apply_mapping((s or {}).get("protocolSection") or {}, _V2_FIELDS)
+        for s in data.get("studies", [])
+    ]
+    # Apply same filters
+    filtered = _filter_studies(mapped, extracted)
+    return {"expr": expr, "count": len(filtered), "studies": filtered[:15], "endpoint": CLINICAL_TRIALS_V2_STUDIES}
+
+
+# Endpoints are raced; the first response with studies wins. When none has any,
+# an empty success is taken in this (preference) order.
+_TRIAL_SOURCES = [
+    ("study_fields", _query_study_fields),
+    ("full_studies", _query_full_studies),
+    ("v2", _query_v2),
+]
+
+
+def _query_trials_uncached(extracted: Dict[str, Any], expr: str, max_rows: int) -> Dict[str, Any]:
+    deadline = time.monotonic() + TRIALS_DEADLINE
+    futures = {
+        _FETCH_POOL.submit(fn, extracted, expr, max_rows, deadline): name
+        for name, fn in _TRIAL_SOURCES
+    }
+    empty: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, str] = {}
+    try:
+        for fut in as_completed(futures, timeout=_remaining(deadline)):
+            name = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:
+                errors[name] = str(e)
+                continue
+            if result.get("studies"):
+                for other in futures:
+                    other.cancel()
+                return result
+            empty[name] = result
+    except FuturesTimeout:
+        for fut, name in futures.items():
+            if name not in empty and name not in errors:
+                fut.cancel()
+                errors[name] = "timed out"
+    for name, _ in _TRIAL_SOURCES:
+        if name in empty:
+            return empty[name]
+    return {
+        "expr": expr,
+        "count": 0,
+        "studies": [],
+        "error": "; ".join(f"{name} error: {errors[name]}" for name, _ in _TRIAL_SOURCES),
+        "endpoint": CLINICAL_TRIALS_V2_STUDIES,
+    }
+
+
 # ---------- Routes ----------
 
+def _run_upstream(fn, *args):
+    """Run fn on _IO and wait at most UPSTREAM_TIMEOUT, counted from submission so
+    time spent queued is included. A job that only reaches a thread after the
+    deadline is skipped rather than run for a caller that has given up."""
+    deadline = time.monotonic() + UPSTREAM_TIMEOUT
+
+    def job():
+        if time.monotonic() >= deadline:
+            raise FuturesTimeout()
+        return fn(*args)
+
+    return _IO.submit(job).result(timeout=UPSTREAM_TIMEOUT)
+
+
+def _json_response(obj: Any, status: int = 200) -> Response:
+    """orjson-backed replacement for jsonify."""
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+
 @app.route("/api/health", methods=["GET"])  # simple readiness probe
 def health():
-    return jsonify({"ok": True})
+    return _json_response({"ok": True})
 
 
 @app.route("/api/extract", methods=["POST"])
@@ -533,9 +805,13 @@ def extract():
     payload = request.get_json(force=True)
     transcript = payload.get("transcript", "") if isinstance(payload, dict) else ""
     if not transcript:
-        return jsonify({"error": "Missing transcript"}), 400
-    data = _gemini_extract(transcript)
-    return jsonify({"extracted": data})
+        return _json_response({"error": "Missing transcript"}, 400)
+    try:
+        data = _run_upstream(_gemini_extract, transcript)
+    except FuturesTimeout:
+        # Same safe fallback the extractor itself uses when Gemini fails
+        data = _regex_extract(transcript)
+    return _json_response({"extracted": data})
 
 
 @app.route("/api/match", methods=["POST"])
@@ -543,12 +819,18 @@ def match():
     payload = request.get_json(force=True)
     transcript = payload.get("transcript", "") if isinstance(payload, dict) else ""
     if not transcript:
-        return jsonify({"error": "Missing transcript"}), 400
-    extracted = _gemini_extract(transcript)
-    results = query_trials(extracted)
+        return _json_response({"error": "Missing transcript"}, 400)
+    try:
+        extracted = _run_upstream(_gemini_extract, transcript)
+    except FuturesTimeout:
+        extracted = _regex_extract(transcript)
+    try:
+        results = _run_upstream(query_trials, extracted)
+    except FuturesTimeout:
+        return _json_response({"extracted": extracted, "error": "Trial search timed out"}, 504)
     if isinstance(results, dict) and results.get("error"):
-        return jsonify({"extracted": extracted, "results": results}), 502
-    return jsonify({"extracted": extracted, "results": results})
+        return _json_response({"extracted": extracted, "results": results}, 502)
+    return _json_response({"extracted": extracted, "results": results})
 
 
 if __name__ == "__main__":